@@ -0,0 +1,21 @@
+"""
+Optional Numba support.
+Exposes ``njit`` and ``prange``; when Numba isn't installed they fall back to a
+no-op decorator and the builtin ``range`` so kernels still run as plain Python.
+"""
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """No-op stand-in for ``numba.njit`` (supports bare and parameterized use)."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+        return decorator
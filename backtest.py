@@ -6,10 +6,9 @@ Evaluates rolling 5-year windows across historical periods and applies note logi
 
 import numpy as np
 import pandas as pd
-import yfinance as yf
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 import datetime as dt
+from backtest_core import run_backtest
 
 # Note Structure Parameters
 T_years = 5                   # Maturity in years. Default: 5 years (CAIE typical maturity)
@@ -24,140 +23,24 @@ start_symbol = '^GSPC'        # Index symbol. Default: S&P 500
 start_date = '2000-01-01'     # Earliest date to fetch. Default: 1928 (start of S&P 500 data)
 end_date = dt.date.today().isoformat()  # Latest date (today)
 
-print("Downloading S&P500 history...")
-df = yf.download(start_symbol, start=start_date, end=end_date, progress=False)
-if df.empty:
-    raise RuntimeError("Failed to download data. Run locally with internet access or provide CSV.")
-
-# Handle MultiIndex columns from yfinance
-if isinstance(df.columns, pd.MultiIndex):
-    df.columns = df.columns.droplevel(1)
-
-price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
-prices = df[price_col].copy()
-prices.name = 'price'
-prices = prices.dropna()
-prices = prices.asfreq('B', method='pad')  # Resample to business daily
-
-# Generate rolling window start dates
-min_date = prices.index[0]
-max_date = prices.index[-1] - pd.DateOffset(years=T_years)
-start_dates = prices.loc[:max_date].index
-
-print(f"Total historical start dates to evaluate: {len(start_dates)}")
-
-
-def evaluate_window(prices_series, start_ts, T_years,
-                    monthly_barrier, autocall_trigger, coupon_annual, fee_annual):
-    """
-    Evaluate one historical window for note performance.
-    
-    Returns dict with: 'called', 'total_return', 'principal_loss', 
-                       'principal_loss_amount', 'missed_coupon_months', 
-                       'duration_months', 'duration_years'
-    """
-    S0 = float(prices_series.loc[start_ts])
-    end_ts = start_ts + pd.DateOffset(years=T_years)
-    window = prices_series.loc[start_ts:end_ts]
-    
-    if window.index[-1] < end_ts:
-        return None  # Incomplete window
-    
-    # Generate observation dates
-    monthly_obs = pd.date_range(start=start_ts + pd.offsets.MonthEnd(0),
-                                end=end_ts, freq='ME')
-    annual_obs = [start_ts + pd.DateOffset(years=k) for k in range(1, T_years+1)]
-    
-    accrued_coupons = 0.0
-    monthly_coupon = coupon_annual / 12.0
-    called = False
-    call_time_months = None
-    missed_coupon_months = 0
-    
-    # Evaluate note over time
-    for mo in monthly_obs:
-        # Get price at month-end (use last available if market closed)
-        if mo not in window.index:
-            mo_price = window[:mo].iloc[-1]
-        else:
-            mo_price = window.loc[mo]
-        
-        # Monthly coupon check
-        if mo_price >= monthly_barrier * S0:
-            accrued_coupons += monthly_coupon
-        else:
-            missed_coupon_months += 1
-        
-        # Annual autocall check
-        if mo in annual_obs:
-            chkdate = mo
-            pr = window[:chkdate].iloc[-1]
-            if pr >= autocall_trigger * S0:
-                called = True
-                # Calculate duration in whole months (autocalls happen at annual intervals)
-                years_elapsed = (chkdate - start_ts).days / 365.25
-                call_time_months = int(round(years_elapsed * 12))
-                break
-    
-    # Calculate final payoff
-    principal_loss_amount = 0.0
-    if called:
-        gross_total = 1.0 + accrued_coupons
-        duration_months = call_time_months
-        duration_years = duration_months / 12.0  # For CAGR calculation
-    else:
-        final_price = window.iloc[-1]
-        if final_price >= monthly_barrier * S0:
-            gross_total = 1.0 + accrued_coupons
-        else:
-            # Principal loss: proportional to index decline below barrier
-            principal_loss_amount = 1.0 - (final_price / S0)
-            gross_total = (final_price / S0) + accrued_coupons
-        duration_months = int(T_years * 12)  # 60 months for 5-year note
-        duration_years = T_years
-    
-    # Apply fee drag (using years for continuous compounding)
-    net_total = gross_total * np.exp(-fee_annual * duration_years)
-    total_return = net_total - 1.0
-    
-    return {
-        'called': called,
-        'total_return': total_return,
-        'principal_loss': (not called and window.iloc[-1] < monthly_barrier * S0),
-        'principal_loss_amount': principal_loss_amount,
-        'missed_coupon_months': missed_coupon_months,
-        'duration_months': duration_months,
-        'duration_years': duration_years  # For CAGR calculation
-    }
-
-
-# Evaluate all rolling windows
-results = []
-print("Evaluating rolling windows (this may take a few minutes)...")
-for sd in tqdm(start_dates):
-    res = evaluate_window(prices, sd, T_years, monthly_barrier,
-                          autocall_trigger, coupon_annual, fee_annual)
-    if res is not None:
-        results.append((sd, res))
-
-if len(results) == 0:
-    raise RuntimeError("No complete windows found for given T_years.")
-
-# Aggregate results
-res_df = pd.DataFrame([{
-    'start': r[0],
-    'called': r[1]['called'],
-    'total_return': r[1]['total_return'],
-    'principal_loss': r[1]['principal_loss'],
-    'principal_loss_amount': r[1]['principal_loss_amount'],
-    'missed_coupon_months': r[1]['missed_coupon_months'],
-    'duration_months': r[1]['duration_months'],
-    'duration_years': r[1]['duration_years']
-} for r in results])
-
-# Calculate CAGR (annualized return)
-# CAGR = (1 + total_return)^(1/duration_years) - 1
-res_df['cagr'] = ((1 + res_df['total_return']) ** (1 / res_df['duration_years'])) - 1
+cache_dir = '.cache'          # Local price/results cache directory (delete to force a fresh download)
+cache_max_age_hours = 24      # Re-download/re-evaluate once cached entries are older than this
+n_jobs = 1                    # Worker threads for window evaluation (-1 = one per CPU). Default: 1 (vectorized evaluation is already fast)
+
+# Evaluate all rolling windows (reuses cached results for an unchanged parameter set)
+res_df = run_backtest({
+    'symbol': start_symbol,
+    'start_date': start_date,
+    'end_date': end_date,
+    'T_years': T_years,
+    'monthly_barrier': monthly_barrier,
+    'autocall_trigger': autocall_trigger,
+    'coupon_annual': coupon_annual,
+    'fee_annual': fee_annual,
+    'cache_dir': cache_dir,
+    'cache_max_age_hours': cache_max_age_hours,
+    'n_jobs': n_jobs,
+})
 
 # Print statistics
 print(f"Number of windows evaluated: {len(res_df)}")
@@ -169,45 +52,69 @@ if res_df.principal_loss.sum() > 0:
     print(f"  Max: {res_df[res_df.principal_loss].principal_loss_amount.max():.2%}")
 print("Called early fraction:", res_df.called.mean())
 print("Ever missed coupon (>=1 month missed) fraction:", (res_df.missed_coupon_months > 0).mean())
+
+# All percentiles in one pass per column
+pcts = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+total_return_pcts = np.percentile(res_df['total_return'].to_numpy(), pcts)
+cagr_pcts = np.percentile(res_df['cagr'].to_numpy(), pcts)
 print()
 print("Total return percentiles (net):")
-for p in [1, 5, 10, 25, 50, 75, 90, 95, 99]:
-    print(f"  {p}th pct: {np.percentile(res_df.total_return, p):+.2%}")
+for p, v in zip(pcts, total_return_pcts):
+    print(f"  {p}th pct: {v:+.2%}")
 print()
 print("CAGR (annualized) percentiles:")
-for p in [1, 5, 10, 25, 50, 75, 90, 95, 99]:
-    print(f"  {p}th pct: {np.percentile(res_df.cagr, p):+.2%}")
+for p, v in zip(pcts, cagr_pcts):
+    print(f"  {p}th pct: {v:+.2%}")
 
-# Generate histogram
+# Generate histogram (binned once with NumPy, drawn as a single filled step artist)
+counts, edges = np.histogram(res_df['total_return'].to_numpy(), bins=200)
 plt.figure(figsize=(10, 6))
-plt.hist(res_df.total_return, bins=200, density=False)
+plt.stairs(counts, edges, fill=True)
 plt.xlabel("Total return (net fraction of principal)")
 plt.ylabel("Number of historical windows")
 plt.title(f"Distribution of historical total returns for {T_years}-yr autocallable note (S&P500)")
 plt.grid(alpha=0.2)
-plt.axvline(np.percentile(res_df.total_return, 5), color='r', linestyle='--', label='5th pct')
+plt.axvline(total_return_pcts[pcts.index(5)], color='r', linestyle='--', label='5th pct')
 plt.legend()
 plt.tight_layout()
 plt.savefig('historical_autocall_total_return_hist.png', dpi=150)
 print("Histogram saved to historical_autocall_total_return_hist.png")
 
+# Rank windows once; worst/best tables are head/tail of the same ordering
+ranked = res_df.sort_values('total_return')
+table_cols = ['start', 'total_return', 'cagr', 'principal_loss_amount', 'duration_months', 'principal_loss', 'called', 'missed_coupon_months']
+pct_cols = ['total_return', 'cagr', 'principal_loss_amount']
+
+
+def format_table(rows):
+    """Console view of rows with return columns as percent strings."""
+    table = rows[table_cols].copy()
+    for col in pct_cols:
+        table[col] = table[col].map('{:.2%}'.format)
+    table['duration_months'] = table['duration_months'].astype(int)  # Show as whole months
+    return table.to_string(index=False)
+
+
+def markdown_rows(rows):
+    """Markdown table rows for BACKTEST_ANALYSIS.md, built column-wise."""
+    pct = {col: rows[col].map('{:.2%}'.format) for col in pct_cols}
+    lines = ("| " + rows['start'].dt.strftime('%Y-%m-%d')
+             + " | " + pct['total_return']
+             + " | " + pct['cagr']
+             + " | " + pct['principal_loss_amount']
+             + " | " + rows['duration_months'].astype(int).astype(str)
+             + " | " + rows['called'].map({True: "Yes", False: "No"})
+             + " | " + rows['missed_coupon_months'].astype(int).astype(str) + " |")
+    return "\n".join(lines)
+
+
 # Show worst windows
-worst = res_df.sort_values('total_return').head(25).copy()
-worst['total_return'] = worst['total_return'].apply(lambda x: f"{x:.2%}")
-worst['cagr'] = worst['cagr'].apply(lambda x: f"{x:.2%}")
-worst['principal_loss_amount'] = worst['principal_loss_amount'].apply(lambda x: f"{x:.2%}")
-worst['duration_months'] = worst['duration_months'].astype(int)  # Show as whole months
 print("\nWorst 25 windows (start date, total return, CAGR, principal loss, and details):")
-print(worst[['start', 'total_return', 'cagr', 'principal_loss_amount', 'duration_months', 'principal_loss', 'called', 'missed_coupon_months']].to_string(index=False))
+print(format_table(ranked.head(25)))
 
 # Show best windows
-best = res_df.sort_values('total_return').tail(25).copy()
-best['total_return'] = best['total_return'].apply(lambda x: f"{x:.2%}")
-best['cagr'] = best['cagr'].apply(lambda x: f"{x:.2%}")
-best['principal_loss_amount'] = best['principal_loss_amount'].apply(lambda x: f"{x:.2%}")
-best['duration_months'] = best['duration_months'].astype(int)  # Show as whole months
 print("\nBest 25 windows (start date, total return, CAGR, principal loss, and details):")
-print(best[['start', 'total_return', 'cagr', 'principal_loss_amount', 'duration_months', 'principal_loss', 'called', 'missed_coupon_months']].to_string(index=False))
+print(format_table(ranked.tail(25)))
 
 # Generate markdown tables for documentation (post-2000 data)
 if res_df['start'].min() >= pd.Timestamp('2000-01-01'):
@@ -216,27 +123,15 @@ if res_df['start'].min() >= pd.Timestamp('2000-01-01'):
     print("="*80)
     
     # Worst 25 markdown table
-    worst_md = res_df.sort_values('total_return').head(25).copy()
     print("\n### Worst 25 Windows Table (Post-2000)\n")
     print("| Start Date | Total Return | CAGR | Principal Loss | Duration (Months) | Called Early | Missed Coupon Months |")
     print("|------------|--------------|------|----------------|-------------------|--------------|---------------------|")
-    for _, row in worst_md.iterrows():
-        called_str = "Yes" if row['called'] else "No"
-        tr = f"{row['total_return']:.2%}"
-        cagr = f"{row['cagr']:.2%}"
-        pl = f"{row['principal_loss_amount']:.2%}"
-        print(f"| {row['start'].strftime('%Y-%m-%d')} | {tr} | {cagr} | {pl} | {int(row['duration_months'])} | {called_str} | {int(row['missed_coupon_months'])} |")
+    print(markdown_rows(ranked.head(25)))
     
     # Best 25 markdown table
-    best_md = res_df.sort_values('total_return').tail(25).copy()
     print("\n### Best 25 Windows Table (Post-2000)\n")
     print("| Start Date | Total Return | CAGR | Principal Loss | Duration (Months) | Called Early | Missed Coupon Months |")
     print("|------------|--------------|------|----------------|-------------------|--------------|---------------------|")
-    for _, row in best_md.iterrows():
-        called_str = "Yes" if row['called'] else "No"
-        tr = f"{row['total_return']:.2%}"
-        cagr = f"{row['cagr']:.2%}"
-        pl = f"{row['principal_loss_amount']:.2%}"
-        print(f"| {row['start'].strftime('%Y-%m-%d')} | {tr} | {cagr} | {pl} | {int(row['duration_months'])} | {called_str} | {int(row['missed_coupon_months'])} |")
+    print(markdown_rows(ranked.tail(25)))
     
     print("\n" + "="*80)
\ No newline at end of file
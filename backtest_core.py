@@ -0,0 +1,268 @@
+"""
+Shared historical backtest engine for CAIE-style autocallable notes.
+Loads (cached) price history, scores every rolling window at once and returns
+the per-window results as a DataFrame, memoized per parameter set.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+# Part of the results cache key; bump whenever the window scoring logic changes
+# so stale pickled results are not reused
+RESULTS_CACHE_VERSION = 2
+
+
+def load_prices(symbol, start, end, cache_dir='.cache', max_age_hours=24):
+    """
+    Load a business-daily price series, using a local parquet cache keyed by
+    (symbol, start, end). Downloads via yfinance on a cache miss or stale entry.
+    """
+    # Hashed so distinct symbols ('^GSPC' vs 'GSPC') never collide and characters
+    # like '/' or '=' never reach the filename
+    digest = hashlib.sha1(repr((symbol, start, end)).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"prices_{digest}.parquet")
+    if os.path.exists(cache_path):
+        age_hours = (time.time() - os.path.getmtime(cache_path)) / 3600.0
+        if age_hours < max_age_hours:
+            print(f"Loading cached price history from {cache_path}...")
+            cached = pd.read_parquet(cache_path, engine='pyarrow')['price']
+            return cached.asfreq('B')
+
+    print("Downloading S&P500 history...")
+    df = yf.download(symbol, start=start, end=end, progress=False)
+    if df.empty:
+        raise RuntimeError("Failed to download data. Run locally with internet access or provide CSV.")
+
+    # Handle MultiIndex columns from yfinance
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = df.columns.droplevel(1)
+
+    price_col = 'Adj Close' if 'Adj Close' in df.columns else 'Close'
+    prices = df[price_col].copy()
+    prices.name = 'price'
+    prices = prices.dropna()
+    prices = prices.asfreq('B', method='pad')  # Resample to business daily
+
+    os.makedirs(cache_dir, exist_ok=True)
+    prices.to_frame().to_parquet(cache_path, engine='pyarrow')
+    return prices
+
+
+def month_end_table(prices_arr, idx_i8):
+    """
+    Month-end prices (last available if market closed) of a business-daily series.
+
+    Returns (months, month_end_prices, month_keys): the datetime64[M] month of
+    every row, and the price and month of each month's last row.
+    """
+    months = idx_i8.view('datetime64[ns]').astype('datetime64[M]')
+    month_last_pos = np.flatnonzero(np.append(months[1:] != months[:-1], True))
+    return months, prices_arr[month_last_pos], months[month_last_pos]
+
+
+def evaluate_windows(prices_arr, idx_i8, start_pos, T_years,
+                     monthly_barrier, autocall_trigger, coupon_annual, fee_annual,
+                     month_table=None):
+    """
+    Evaluate every historical window for note performance at once.
+
+    prices_arr/idx_i8 are the float64 prices and int64 (ns) timestamps of a
+    business-daily series; start_pos are integer positions of the start dates.
+    Month-end observation prices are looked up once on the full series and
+    gathered into an (N_windows, T_years*12 + 1) matrix, so all windows are
+    scored with array ops. Windows whose end date is not a trading day are
+    incomplete and dropped. month_table is month_end_table()'s result for the
+    series; pass it in to reuse it across calls.
+
+    Returns dict of arrays with: 'start', 'called', 'total_return',
+                                 'principal_loss', 'principal_loss_amount',
+                                 'missed_coupon_months', 'duration_months',
+                                 'duration_years'
+    """
+    dates = idx_i8.view('datetime64[ns]')
+
+    # Keep only complete windows (end date present in the business-daily series)
+    start_dates = pd.DatetimeIndex(dates[start_pos])
+    end_dates = start_dates + pd.DateOffset(years=T_years)
+    end_i8 = end_dates.as_unit('ns').asi8
+    end_pos = np.searchsorted(idx_i8, end_i8, side='right') - 1
+    complete = idx_i8[end_pos] == end_i8
+    start_pos, end_pos = start_pos[complete], end_pos[complete]
+    start_dates, end_dates = start_dates[complete], end_dates[complete]
+    n_windows = len(start_pos)
+    if n_windows == 0:
+        return None
+
+    S0 = prices_arr[start_pos]
+    final_price = prices_arr[end_pos]
+    rows = np.arange(n_windows)
+
+    # Month-end prices (last available if market closed), computed once for all windows
+    if month_table is None:
+        month_table = month_end_table(prices_arr, idx_i8)
+    months, month_end_prices, month_keys = month_table
+
+    # Monthly observations run from the start's month-end through the last month-end <= end date
+    first_month = np.searchsorted(month_keys, months[start_pos])
+    last_month = (np.searchsorted(month_keys, end_dates.values.astype('datetime64[M]'))
+                  - ~np.asarray(end_dates.is_month_end))
+    n_months = last_month - first_month + 1
+    cols = np.arange(T_years * 12 + 1)
+    valid = cols[None, :] < n_months[:, None]
+    obs_prices = month_end_prices[np.minimum(first_month[:, None] + cols,
+                                             len(month_end_prices) - 1)]
+
+    # Monthly coupon checks
+    coupon_paid = valid & (obs_prices >= monthly_barrier * S0[:, None])
+    coupons_to_date = np.cumsum(coupon_paid, axis=1)
+
+    # Annual autocall checks: every 12th observation, but only when the anniversary
+    # itself falls on that month-end
+    annual_cols = 12 * np.arange(1, T_years + 1)
+    annual_hits = np.zeros((n_windows, T_years), dtype=bool)
+    annual_days = np.zeros((n_windows, T_years), dtype=np.int64)
+    for k in range(1, T_years + 1):
+        anniv = start_dates + pd.DateOffset(years=k)
+        checked = np.asarray(anniv.is_month_end)
+        annual_hits[:, k-1] = checked & (obs_prices[:, annual_cols[k-1]] >= autocall_trigger * S0)
+        annual_days[:, k-1] = (anniv - start_dates).days
+    called = annual_hits.any(axis=1)
+    first_call = annual_hits.argmax(axis=1)
+
+    # Coupons accrue through the call month (or all observations if never called)
+    last_col = np.where(called, annual_cols[first_call], n_months - 1)
+    coupons = coupons_to_date[rows, last_col]
+    accrued_coupons = coupons * (coupon_annual / 12.0)
+    missed_coupon_months = last_col + 1 - coupons
+
+    # Calculate final payoff
+    principal_loss = ~called & (final_price < monthly_barrier * S0)
+    principal_loss_amount = np.where(principal_loss, 1.0 - final_price / S0, 0.0)
+    gross_total = np.where(principal_loss, final_price / S0, 1.0) + accrued_coupons
+
+    # Duration in whole months (autocalls happen at annual intervals)
+    call_months = np.rint(annual_days[rows, first_call] / 365.25 * 12).astype(np.int64)
+    duration_months = np.where(called, call_months, int(T_years * 12))
+    duration_years = np.where(called, duration_months / 12.0, float(T_years))
+
+    # Apply fee drag (using years for continuous compounding)
+    net_total = gross_total * np.exp(-fee_annual * duration_years)
+
+    return {
+        'start': start_dates,
+        'called': called,
+        'total_return': net_total - 1.0,
+        'principal_loss': principal_loss,
+        'principal_loss_amount': principal_loss_amount,
+        'missed_coupon_months': missed_coupon_months,
+        'duration_months': duration_months,
+        'duration_years': duration_years  # For CAGR calculation
+    }
+
+
+def evaluate_windows_parallel(prices_arr, idx_i8, start_pos, n_jobs, *note_params):
+    """
+    Split start_pos into n_jobs contiguous blocks (-1 = one per CPU), run
+    evaluate_windows on each block in a worker thread and concatenate the
+    results. Workers share the plain NumPy inputs, which release the GIL
+    in the heavy array ops, and one month-end table built up front.
+
+    note_params are evaluate_windows' trailing arguments (T_years, monthly_barrier,
+    autocall_trigger, coupon_annual, fee_annual). Returns None if no window is complete.
+    """
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    blocks = [b for b in np.array_split(start_pos, max(n_jobs, 1)) if len(b)]
+    if len(blocks) <= 1:
+        return evaluate_windows(prices_arr, idx_i8, start_pos, *note_params)
+
+    month_table = month_end_table(prices_arr, idx_i8)
+    with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+        parts = list(pool.map(lambda b: evaluate_windows(prices_arr, idx_i8, b, *note_params,
+                                                         month_table=month_table),
+                              blocks))
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+
+@functools.lru_cache(maxsize=None)
+def _backtest_results(symbol, start, end, T_years, monthly_barrier, autocall_trigger,
+                      coupon_annual, fee_annual, cache_dir, max_age_hours, n_jobs):
+    """
+    Per-window results for one parameter set, memoized in-process and pickled
+    under cache_dir (same freshness rule as the price cache).
+    """
+    params = (RESULTS_CACHE_VERSION, symbol, start, end, T_years, monthly_barrier,
+              autocall_trigger, coupon_annual, fee_annual)
+    digest = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"backtest_{digest}.pkl")
+    if os.path.exists(cache_path):
+        age_hours = (time.time() - os.path.getmtime(cache_path)) / 3600.0
+        if age_hours < max_age_hours:
+            print(f"Loading cached backtest results from {cache_path}...")
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+
+    prices = load_prices(symbol, start, end, cache_dir, max_age_hours)
+
+    # Plain float64 prices and int64 (ns) timestamps for position-based lookups
+    prices_arr = np.ascontiguousarray(prices.to_numpy(dtype=np.float64))
+    idx_i8 = prices.index.as_unit('ns').asi8
+
+    # Generate rolling window start dates (as integer positions into prices_arr)
+    max_date = prices.index[-1] - pd.DateOffset(years=T_years)
+    start_pos = np.arange(np.searchsorted(idx_i8, max_date.value, side='right'))
+
+    print(f"Total historical start dates to evaluate: {len(start_pos)}")
+
+    # Evaluate all rolling windows
+    print("Evaluating rolling windows...")
+    results = evaluate_windows_parallel(prices_arr, idx_i8, start_pos, n_jobs, T_years,
+                                        monthly_barrier, autocall_trigger, coupon_annual,
+                                        fee_annual)
+
+    if results is None:
+        raise RuntimeError("No complete windows found for given T_years.")
+
+    # Calculate CAGR (annualized return)
+    # CAGR = (1 + total_return)^(1/duration_years) - 1
+    results['cagr'] = (1.0 + results['total_return']) ** (1.0 / results['duration_years']) - 1.0
+
+    # Aggregate results: one typed column per array, no per-row objects
+    res_df = pd.DataFrame(results)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        pickle.dump(res_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return res_df
+
+
+def run_backtest(params):
+    """
+    Run the rolling-window backtest described by params and return one row per window.
+
+    params keys: 'symbol', 'start_date', 'end_date', 'T_years', 'monthly_barrier',
+                 'autocall_trigger', 'coupon_annual', 'fee_annual', and optionally
+                 'cache_dir' (default '.cache'), 'cache_max_age_hours' (default 24)
+                 and 'n_jobs' (worker threads, default 1; -1 = one per CPU)
+
+    Returns DataFrame with: 'start', 'called', 'total_return', 'principal_loss',
+                            'principal_loss_amount', 'missed_coupon_months',
+                            'duration_months', 'duration_years', 'cagr'
+    """
+    res_df = _backtest_results(
+        params['symbol'], params['start_date'], params['end_date'], params['T_years'],
+        params['monthly_barrier'], params['autocall_trigger'], params['coupon_annual'],
+        params['fee_annual'], params.get('cache_dir', '.cache'),
+        params.get('cache_max_age_hours', 24), params.get('n_jobs', 1))
+    return res_df.copy()
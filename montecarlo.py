@@ -4,12 +4,15 @@ Monte Carlo simulation of a representative autocallable note (CAIE-style).
 Simulates price paths using geometric Brownian motion and evaluates note payoffs.
 """
 
+import math
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from _njit import NUMBA_AVAILABLE
+from payoff_kernel import evaluate_paths
 
 # Simulation Parameters
-S0 = 100.0            # Starting index level (normalized to 100)
+S0 = 100.0            # Starting index level (normalized to 100; payoffs only depend on S/S0)
 mu = 0.07             # Annual drift (expected return). Default: 7% (typical equity market)
 sigma = 0.18          # Annual volatility. Default: 18% (S&P 500 historical volatility)
 T = 5.0               # Maturity in years. Default: 5 years (CAIE typical maturity)
@@ -25,62 +28,107 @@ call_interval_years = 1  # Autocall check frequency (years). Default: 1 year (an
 # Simulation Settings
 n_sims = 200000       # Number of Monte Carlo simulations. Default: 200k (higher = smoother tails, slower)
 seed = 42             # Random seed for reproducibility
-np.random.seed(seed)
+antithetic = True     # Pair each normal draw z with -z (variance reduction at no extra RNG cost)
+path_dtype = np.float32  # Precision of normals/log-paths. Default: float32 (half the memory traffic; results stay float64)
+tile_sims = 4096      # Paths simulated per block. Default: 4096 (~20 MB of float32 normals; bounds peak memory)
+use_numba = NUMBA_AVAILABLE  # Per-path compiled kernel if Numba is installed, else vectorized NumPy
 
 # Derived calculations
 steps = int(T / dt)
-monthly_indices = set((np.round(np.arange(1, int(T*12)+1) * (1/12) / dt)).astype(int))
-annual_indices = set((np.round(np.arange(1, int(T/call_interval_years)+1) * call_interval_years / dt)).astype(int))
+# Observation dates as sorted step indices (0 = start of path)
+monthly_idx = np.round(np.arange(1, int(T*12)+1) * (1/12) / dt).astype(np.int32)
+annual_idx = np.round(np.arange(1, int(T/call_interval_years)+1) * call_interval_years / dt).astype(np.int32)
+# Same dates as per-step lookup tables for the per-path kernel
+is_monthly = np.zeros(steps + 1, dtype=np.bool_)
+is_monthly[monthly_idx] = True
+is_annual = np.zeros(steps + 1, dtype=np.bool_)
+is_annual[annual_idx] = True
 monthly_coupon = coupon_annual / 12.0
+rng = np.random.default_rng(seed)  # PCG64 generator shared by both engines
+
+
+def standard_normals(rng, n_sims, steps, antithetic, dtype=np.float64):
+    """
+    Draw an (n_sims, steps) block of standard normals of the given float dtype.
+    With antithetic=True only the first half of the rows is drawn and the
+    second half is its negation.
+    """
+    if not antithetic:
+        return rng.standard_normal((n_sims, steps), dtype=dtype)
+    z = np.empty((n_sims, steps), dtype=dtype)
+    half = (n_sims + 1) // 2
+    rng.standard_normal(dtype=dtype, out=z[:half])
+    np.negative(z[:n_sims - half], out=z[half:])
+    return z
+
+
+def simulate_vectorized(z, dt, mu, sigma, monthly_idx, annual_idx,
+                        monthly_barrier, autocall_trigger, monthly_coupon, fee_annual, T,
+                        out_tot, out_cagr):
+    """
+    Evaluate every row of the (n_sims, steps) normal block z at once on a
+    matrix of log(S/S0) in z's dtype. Peak memory grows with n_sims * steps,
+    so callers pass one tile of paths at a time. z is used as the working
+    buffer and overwritten. Payoffs are computed in float64.
+    """
+    n_sims = z.shape[0]
+    # Barriers in log space: S >= k*S0  <=>  log(S/S0) >= log(k); a barrier <= 0
+    # is always met, so it maps to -inf rather than math.log(0)
+    log_barrier = math.log(monthly_barrier) if monthly_barrier > 0 else -math.inf
+    log_call = math.log(autocall_trigger) if autocall_trigger > 0 else -math.inf
+
+    # Generate geometric Brownian motion log-paths, one row per simulation;
+    # column j holds step j+1 (step 0 is log(S0/S0) = 0 and is never observed)
+    drift = z.dtype.type((mu - 0.5 * sigma**2) * dt)
+    vol = z.dtype.type(sigma * math.sqrt(dt))
+    z *= vol
+    z += drift
+    log_prices = np.cumsum(z, axis=1, out=z)
+
+    # Monthly coupon checks: column k holds the coupons paid over the first k monthly
+    # observations (column 0 = none, for a call before the first observation)
+    coupon_hits = log_prices[:, monthly_idx - 1] >= log_barrier
+    coupons_paid = np.zeros((n_sims, len(monthly_idx) + 1), dtype=np.int64)
+    np.cumsum(coupon_hits, axis=1, out=coupons_paid[:, 1:])
+
+    # Annual autocall checks: note is called at the first annual observation at/above trigger
+    annual_hits = log_prices[:, annual_idx - 1] >= log_call
+    called = annual_hits.any(axis=1)
+    first_call = np.where(called, annual_hits.argmax(axis=1), -1)
+    call_idx = annual_idx[first_call]  # only meaningful where called
+
+    # Coupons accrue over monthly observations up to and including the call step
+    # (or all of them if never called)
+    n_obs = np.where(called, np.searchsorted(monthly_idx, call_idx, side='right'), len(monthly_idx))
+    accrued_coupons = coupons_paid[np.arange(n_sims), n_obs] * monthly_coupon
+
+    # Calculate final payoff
+    final_ratio = np.exp(log_prices[:, -1].astype(np.float64))
+    principal = np.where(final_ratio >= monthly_barrier, 1.0, final_ratio)
+    gross_total = np.where(called, 1.0, principal) + accrued_coupons
+
+    # Apply fee drag (continuous compounding)
+    duration = np.where(called, call_idx * dt, T)
+    net_total = gross_total * np.exp(-fee_annual * duration)
+
+    out_tot[:] = net_total - 1.0
+    out_cagr[:] = net_total ** (1.0 / duration) - 1.0
+
 
 # Results arrays
 total_returns = np.zeros(n_sims)
 annualized_returns = np.zeros(n_sims)
 
-# Monte Carlo simulation
-for sim in range(n_sims):
-    # Generate geometric Brownian motion path
-    z = np.random.randn(steps)
-    log_returns = (mu - 0.5 * sigma**2) * dt + sigma * np.sqrt(dt) * z
-    log_prices = np.concatenate([[0.0], np.cumsum(log_returns)])
-    prices = S0 * np.exp(log_prices)
-    
-    accrued_coupons = 0.0
-    called = False
-    call_time = None
-    
-    # Evaluate note over time
-    for idx in range(1, steps + 1):
-        price = prices[idx]
-        
-        # Monthly coupon check
-        if idx in monthly_indices:
-            if price >= monthly_barrier * S0:
-                accrued_coupons += monthly_coupon
-        
-        # Annual autocall check
-        if idx in annual_indices:
-            if price >= autocall_trigger * S0:
-                called = True
-                call_time = idx * dt
-                break
-    
-    # Calculate final payoff
-    if called:
-        gross_total = 1.0 + accrued_coupons
+# Monte Carlo simulation, streamed in tiles: only the two result arrays span all paths
+note_args = (monthly_barrier, autocall_trigger, monthly_coupon, fee_annual, T)
+for start in range(0, n_sims, tile_sims):
+    stop = min(start + tile_sims, n_sims)
+    z = standard_normals(rng, stop - start, steps, antithetic, path_dtype)
+    out = (total_returns[start:stop], annualized_returns[start:stop])
+    if use_numba:
+        evaluate_paths(z, dt, mu, sigma, is_monthly, is_annual, *note_args, *out)
     else:
-        final_price = prices[-1]
-        if final_price >= monthly_barrier * S0:
-            gross_total = 1.0 + accrued_coupons
-        else:
-            gross_total = (final_price / S0) + accrued_coupons
-    
-    # Apply fee drag (continuous compounding)
-    duration = call_time if called else T
-    net_total = gross_total * np.exp(-fee_annual * duration)
-    
-    total_returns[sim] = net_total - 1.0
-    annualized_returns[sim] = ((net_total) ** (1.0 / (duration if duration > 0 else T))) - 1.0
+        simulate_vectorized(z, dt, mu, sigma, monthly_idx, annual_idx, *note_args, *out)
 
 # Aggregate results
 df = pd.DataFrame({
@@ -88,27 +136,32 @@ df = pd.DataFrame({
     "annualized_return": annualized_returns
 })
 
+# Median, 5th and 95th percentiles in one pass per column
+tr_median, tr_p5, tr_p95 = np.percentile(total_returns, [50, 5, 95])
+ar_median, ar_p5, ar_p95 = np.percentile(annualized_returns, [50, 5, 95])
+
 # Print statistics
 print("Simulations:", n_sims)
 print("\n=== TOTAL RETURNS (over investment period) ===")
 print("Mean total return (net): {:.2%}".format(df.total_return.mean()))
-print("Median total return (net): {:.2%}".format(df.total_return.median()))
-print("5th percentile total return (net): {:.2%}".format(np.percentile(df.total_return, 5)))
-print("95th percentile total return (net): {:.2%}".format(np.percentile(df.total_return, 95)))
+print("Median total return (net): {:.2%}".format(tr_median))
+print("5th percentile total return (net): {:.2%}".format(tr_p5))
+print("95th percentile total return (net): {:.2%}".format(tr_p95))
 print("Max total return (net): {:.2%}".format(df.total_return.max()))
 print("Min total return (net): {:.2%}".format(df.total_return.min()))
 
 print("\n=== CAGR / ANNUALIZED RETURNS ===")
 print("Mean annualized return (CAGR): {:.2%}".format(df.annualized_return.mean()))
-print("Median annualized return (CAGR): {:.2%}".format(df.annualized_return.median()))
-print("5th percentile annualized return (CAGR): {:.2%}".format(np.percentile(df.annualized_return, 5)))
-print("95th percentile annualized return (CAGR): {:.2%}".format(np.percentile(df.annualized_return, 95)))
+print("Median annualized return (CAGR): {:.2%}".format(ar_median))
+print("5th percentile annualized return (CAGR): {:.2%}".format(ar_p5))
+print("95th percentile annualized return (CAGR): {:.2%}".format(ar_p95))
 print("Max annualized return (CAGR): {:.2%}".format(df.annualized_return.max()))
 print("Min annualized return (CAGR): {:.2%}".format(df.annualized_return.min()))
 
-# Generate histogram
+# Generate histogram (binned once with NumPy, drawn as a single filled step artist)
+density, edges = np.histogram(total_returns, bins=200, density=True)
 plt.figure(figsize=(9, 5))
-plt.hist(df.total_return, bins=200, density=True, edgecolor='none')
+plt.stairs(density, edges, fill=True)
 plt.title("Monte Carlo distribution of representative CAIE note total return (net of fees)")
 plt.xlabel("Total return over investment period (fraction)")
 plt.ylabel("Density")
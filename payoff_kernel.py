@@ -0,0 +1,65 @@
+"""
+Compiled per-path payoff kernel for CAIE-style autocallable notes.
+Scores GBM paths from pre-drawn normals with a scalar state machine; compiled
+by Numba (parallel, GIL released) when available, plain Python otherwise.
+"""
+
+import math
+from _njit import njit, prange
+
+
+# fastmath without 'ninf': barriers may be -inf (always met)
+@njit(parallel=True, nogil=True, cache=True,
+      fastmath={'nnan', 'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+def evaluate_paths(z, dt, mu, sigma, is_monthly, is_annual,
+                   monthly_barrier, autocall_trigger, monthly_coupon, fee_annual, T,
+                   out_tot, out_cagr):
+    """
+    Evaluate each row of the (n_sims, steps) normal block z as one path,
+    streaming its GBM log(S/S0) as a float64 scalar (z may be float32).
+    Barriers are checked in log space, so only the final price is exponentiated.
+    """
+    n_sims, steps = z.shape
+    drift = (mu - 0.5 * sigma**2) * dt
+    vol = sigma * math.sqrt(dt)
+    # A barrier <= 0 is always met, so it maps to -inf rather than math.log(0)
+    log_barrier = math.log(monthly_barrier) if monthly_barrier > 0 else -math.inf
+    log_call = math.log(autocall_trigger) if autocall_trigger > 0 else -math.inf
+
+    for sim in prange(n_sims):
+        log_price = 0.0
+        accrued_coupons = 0.0
+        called = False
+        duration = T
+
+        # Evaluate note over time
+        for idx in range(1, steps + 1):
+            log_price += drift + vol * z[sim, idx - 1]
+
+            # Monthly coupon check
+            if is_monthly[idx]:
+                if log_price >= log_barrier:
+                    accrued_coupons += monthly_coupon
+
+            # Annual autocall check
+            if is_annual[idx]:
+                if log_price >= log_call:
+                    called = True
+                    duration = idx * dt
+                    break
+
+        # Calculate final payoff
+        if called:
+            gross_total = 1.0 + accrued_coupons
+        else:
+            final_ratio = math.exp(log_price)
+            if final_ratio >= monthly_barrier:
+                gross_total = 1.0 + accrued_coupons
+            else:
+                gross_total = final_ratio + accrued_coupons
+
+        # Apply fee drag (continuous compounding)
+        net_total = gross_total * math.exp(-fee_annual * duration)
+
+        out_tot[sim] = net_total - 1.0
+        out_cagr[sim] = net_total ** (1.0 / duration) - 1.0